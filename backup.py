@@ -2,20 +2,80 @@
 
 import json
 import os
+import re
 import shutil
 import sys
 import tempfile
 import zipfile
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from operator import attrgetter
 from pathlib import Path
-from typing import Any, Generator, List, Set, Tuple, Union
+from typing import Any, Callable, Deque, Generator, Iterable, List, Optional, Set, Tuple, Union
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # SIMD accelerated drop-in replacement of zlib, also used by zipfile for ZIP_DEFLATED members
+    from zlib_ng import zlib_ng as zlib
+    zipfile.zlib = zlib
+except ImportError:
+    import zlib
 
 __version__ = "1.3.2"
 __all__ = ['BackupManager']
 
 DEFAULT_DENYLIST = {'__pycache__', '.vscode', '.zip', }
-NAMEDTEMPORARYFILE_NAME = None
+TEMPORARYFILE_NAME = None
+
+BACKUP_NAME_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})-(.+)\.zip$')
+"""name of dated backups, as year, month, day and arcname"""
+
+STORED_SUFFIXES = {
+    '.zip', '.7z', '.rar', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.whl', '.jar', '.apk',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a', '.opus',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm',
+    '.docx', '.xlsx', '.pptx', '.epub', '.pdf',
+}
+"""already compressed formats, stored into zipfile without compression"""
+
+STORE_SAMPLE_THRESHOLD = 4 << 20
+"""files from this size are sampled before compression, stored if the sample doesn't shrink"""
+
+STORE_SAMPLE_SIZE = 64 << 10
+"""size of the sample read from the head of a file"""
+
+STORE_SAMPLE_RATIO = 0.95
+"""files whose sample compresses above this ratio are stored"""
+
+LOG_BATCH_SIZE = 256
+"""number of progress lines buffered before written to stderr"""
+
+SAMPLE_WINDOW = 64
+"""maximum number of entries looked ahead for sampling during compress"""
+
+def _dumps(obj) -> bytes:
+    """serialize config, with orjson if it's installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode()
+
+def _loads(data:bytes):
+    """deserialize config, with orjson if it's installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 class bcolors:
     HEADER =    '\033[95m'
@@ -28,6 +88,9 @@ class bcolors:
     BOLD =      '\033[1m'
     UNDERLINE = '\033[4m'
 
+PATH_COLORS = (bcolors.OKBLUE, bcolors.OKCYAN, bcolors.OKGREEN)
+"""rotating colors of path components"""
+
 
 class BackupManager:
     def __init__(self, target:Union[Path, str], save:Union[Path, str], *, 
@@ -75,11 +138,11 @@ class BackupManager:
             self.__arcname = f'{self.__today.strftime("%Y-%m-%d")}-{arcname}.zip'
             
         
-        self.__denylist:Set[str]
-        """blacklist of keywords for paths, priority is lower than self.__allowlist"""
+        self.__denylist:Tuple[str, ...]
+        """sorted blacklist of keywords for paths, priority is lower than self.__allowlist"""
         
-        self.__allowlist:Set[str] = set()
-        """whitelist of keywords for paths, priority is higher than self.__denylist"""
+        self.__allowlist:Tuple[str, ...] = ()
+        """sorted whitelist of keywords for paths, priority is higher than self.__denylist"""
         
         (self.__save/'cache').mkdir(parents=True, exist_ok=True)
         self._cache = self.__save/f'cache/{arcname}.json'
@@ -93,9 +156,21 @@ class BackupManager:
         
         self.__depth_counter = 0
         
+        self.__is_tty = sys.stderr.isatty()
+        """color the output while True, decided once since stderr doesn't change during a run"""
+        
+        self.__matcher_dirty = True
+        """rebuild the allowlist and denylist matchers before next isValid while True"""
+        
+        self.__allow_match:Callable[[str], bool]
+        self.__deny_match:Callable[[str], bool]
+        
+        self.__namelist_cache:Optional[List[Tuple[str, str, bool, Optional[int]]]] = None
+        """walk result of target directory, shared by namelist, arcnamelist and compress"""
+        
         if required_config and self._cache.exists():
-            self.__denylist = set()
-            info = json.load(self._cache.open('r'))
+            self.__denylist = ()
+            info = _loads(self._cache.read_bytes())
             self.include(info['allowlist'])
             self.exclude(info['denylist'])
             
@@ -104,7 +179,7 @@ class BackupManager:
                     continue
                 self.__dict__[name] = info[name]
         else:
-            self.__denylist = DEFAULT_DENYLIST.copy()
+            self.__denylist = tuple(sorted(map(sys.intern, DEFAULT_DENYLIST)))
 
     def __repr__(self) -> str:
         return f'BackupManager(path="{self.__target}", arcname="{self.__arcname}")'
@@ -134,8 +209,8 @@ class BackupManager:
         """config dict"""
         
         res = {
-            'allowlist' : sorted(self.__allowlist),
-            'denylist'  : sorted(self.__denylist) 
+            'allowlist' : list(self.__allowlist),
+            'denylist'  : list(self.__denylist) 
         }
         for key, value in self.__dict__.items():
             if key.startswith('_'):
@@ -149,101 +224,135 @@ class BackupManager:
     
     def exclude(self, pattern:Union[List[str], Set[str], str]):
         """append the pattern to denylist"""
-        if isinstance(pattern, (list, set)):
-            self.__denylist.update(pattern)
-        else:
-            self.__denylist.add(pattern)
+        if not isinstance(pattern, (list, set)):
+            pattern = [pattern]
+        self.__denylist = tuple(sorted(set(self.__denylist).union(map(sys.intern, pattern))))
+        self.__matcher_dirty = True
+        self.__namelist_cache = None
         return self
     
     def include(self, pattern:Union[List[str], Set[str], str]):
         """append the pattern to allowlist"""
-        if isinstance(pattern, (list, set)):
-            self.__allowlist.update(pattern)
-        else:
-            self.__allowlist.add(pattern)
+        if not isinstance(pattern, (list, set)):
+            pattern = [pattern]
+        self.__allowlist = tuple(sorted(set(self.__allowlist).union(map(sys.intern, pattern))))
+        self.__matcher_dirty = True
+        self.__namelist_cache = None
         return self
         
-    def isValid(self, path:Path):
-        """check the path is valid due to allowlist and denylist"""
-        path = str(path) + '/' if path.is_dir() else str(path)
-        res = any(pattern in path for pattern in self.__allowlist)
-        return res if res else not any(pattern in path for pattern in self.__denylist)
+    def isValid(self, path:Union[Path, str], is_dir:Optional[bool]=None):
+        """check the path is valid due to allowlist and denylist
+
+        Args:
+            path (Union[Path, str]): path to check
+            is_dir (bool, optional): whether path is a directory. If None, then it's checked on the filesystem. Defaults to None.
+        """
+        if self.__matcher_dirty:
+            self.__allow_match = self.__build_matcher(self.__allowlist)
+            self.__deny_match = self.__build_matcher(self.__denylist)
+            self.__matcher_dirty = False
+        
+        if is_dir is None:
+            is_dir = os.path.isdir(path)
+        path = str(path) + '/' if is_dir else str(path)
+        if self.__allow_match(path):
+            return True
+        return not self.__deny_match(path)
+    
+    @staticmethod
+    def __build_matcher(patterns:Iterable[str]) -> Callable[[str], bool]:
+        """build a function checking whether any pattern is a substring of a path
+        
+        Uses an Aho-Corasick automaton if pyahocorasick is installed, a single compiled regex otherwise.
+        """
+        patterns = sorted(set(patterns), key=lambda x:(-len(x), x)) # longest first, the most specific alternative is tried first
+        if not patterns:
+            return lambda path: False
+        
+        if ahocorasick is not None and '' not in patterns:
+            automaton = ahocorasick.Automaton()
+            for pattern in patterns:
+                automaton.add_word(pattern, pattern)
+            automaton.make_automaton()
+            return lambda path: next(automaton.iter(path), None) is not None
+        
+        regex = re.compile('|'.join(re.escape(pattern) for pattern in patterns))
+        return lambda path: regex.search(path) is not None
     
     def __color_path(self, path:str):
         """coloring the path"""
-        colors = [bcolors.OKBLUE, bcolors.OKCYAN, bcolors.OKGREEN]
-        res = []
-        
         is_dir = path[-1] == '/'
-        path = path.split('/')
+        depth = path.count('/') if is_dir else path.count('/') + 1
+        parts = path.split('/', depth - 1)
+        last = depth - 1
+        res = [PATH_COLORS[i % len(PATH_COLORS)] + parts[i] for i in range(last)]
         if is_dir:
-            path = path[:-1]
-            
-        for i in range(len(path)-1):
-            res.append(colors[i % len(colors)] + path[i])
-        if is_dir:
-            i = len(path) - 1
-            res.append(colors[i % len(colors)] + path[-1] + '/')
+            res.append(PATH_COLORS[last % len(PATH_COLORS)] + parts[last])
         else:
-            res.append(bcolors.WARNING + path[-1])
-            
-        depth = len(res)
-        if depth > self.__depth_counter:
-            self.__depth_counter = depth
-        
+            res.append(bcolors.WARNING + parts[last])
         return '/'.join(res) + bcolors.ENDC
     
-    def __namelist(self, path:Path, parent:Path=None)->Generator[Tuple[str, str], Any, None]:
-        """list all files and folders from target directory"""
-        if not self.isValid(path):
+    def __namelist(self, path:Path)->Generator[Tuple[str, str, bool, Optional[int]], Any, None]:
+        """list all files and folders from target directory, as (filename, arcname, is_file, file_size)"""
+        if not self.isValid(path, path.is_dir()):
             return
         
-        if parent is None:
-            parent = Path(path.name)
-        else:
-            parent = parent/path.name
-        
         if path.is_file():
-            yield str(path), str(parent)
+            self.__depth_counter = max(self.__depth_counter, 1)
+            yield str(path), path.name, True, path.stat().st_size
             return
         
-        paths = [p for p in path.iterdir()]
-        files = sorted([f for f in paths if f.is_file()], key=lambda x:x.name)
-        folders = sorted([d for d in paths if d.is_dir()], key=lambda x:x.name)
-
-        yield str(path)+'/', str(parent)+'/'
-        for file in files:
-            yield from self.__namelist(file, parent)
-        del files
-        
-        for folder in folders:
-            yield from self.__namelist(folder, parent)
+        stack = [(str(path), path.name + '/', 1)]
+        while stack:
+            directory, parent, depth = stack.pop()
+            files:List[os.DirEntry] = []
+            folders:List[os.DirEntry] = []
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_file():
+                        if self.isValid(entry.path, False):
+                            files.append(entry)
+                    elif entry.is_dir():
+                        if self.isValid(entry.path, True):
+                            folders.append(entry)
+            files.sort(key=attrgetter('name'))
+            folders.sort(key=attrgetter('name'), reverse=True) # popped from stack in name order
+            
+            self.__depth_counter = max(self.__depth_counter, depth + 1 if files else depth)
+            yield directory + '/', parent, False, None
+            for file in files:
+                yield file.path, parent + file.name, True, file.stat().st_size
+            stack.extend((folder.path, parent + folder.name + '/', depth + 1) for folder in folders)
+    
+    def __entries(self) -> List[Tuple[str, str, bool, Optional[int]]]:
+        """walk the target directory once and reuse the result afterwards"""
+        if self.__namelist_cache is None:
+            self.__namelist_cache = list(self.__namelist(self.__target))
+        return self.__namelist_cache
     
     @property
     def namelist(self):
         """list all files and folders from target directory"""
-        return [path[0] for path in self.__namelist(self.__target)]
+        return [path[0] for path in self.__entries()]
     
     @property
     def arcnamelist(self):
         """list all files and folders from save zipfile"""
-        return [path[1] for path in self.__namelist(self.__target)]
+        return [path[1] for path in self.__entries()]
     
-    def __find_files(self) -> List[Tuple[Path, datetime]]:
+    def __find_files(self) -> Generator[Tuple[str, datetime], Any, None]:
         """find all backups contains same name with arcname"""
         target = self.__arcname[11:-4]
-        for file in self.__save.iterdir():
-            if file.is_dir() or file.suffix != '.zip':
-                continue
-            _date = file.name[:10].split('-')
-            if len(_date) != 3:
-                continue
-            date = datetime(year=int(_date[0]), month=int(_date[1]), day=int(_date[2]))
-
-            # 强一致性
-            name = file.name[11:-4]
-            if name == target:
-                yield file, date
+        with os.scandir(self.__save) as it:
+            for entry in it:
+                if not entry.name.endswith('.zip') or entry.is_dir():
+                    continue
+                match = BACKUP_NAME_PATTERN.match(entry.name)
+                
+                # 强一致性
+                if match is None or match[4] != target:
+                    continue
+                yield entry.path, datetime(year=int(match[1]), month=int(match[2]), day=int(match[3]))
     
     def __auto_clean(self):
         """delete every not-montly-latest backup, except this month"""
@@ -252,7 +361,7 @@ class BackupManager:
             return
         
         print('\ntriggered auto_clean process', file=sys.stderr)
-        files:List[Tuple[Path, datetime]] = []
+        files:List[Tuple[str, datetime]] = []
         
         # get all backup files
         for path, date in self.__find_files():
@@ -268,17 +377,46 @@ class BackupManager:
         
         for path, date in files[1:]:
             if date.month == res.month and date.year == res.year:
-                path.unlink()
-                print(bcolors.FAIL + 'delete' + bcolors.WARNING, path.name, bcolors.ENDC, file=sys.stderr)
+                os.unlink(path)
+                print(bcolors.FAIL + 'delete' + bcolors.WARNING, os.path.basename(path), bcolors.ENDC, file=sys.stderr)
             res = date
         print('done', file=sys.stderr, flush=True)
     
     def __save_config(self):
-        with self._cache.open('w') as f:
-            json.dump(self.info, f, indent=4)
+        """write config file, skipped while its content is unchanged"""
+        data = _dumps(self.info)
+        try:
+            if self._cache.read_bytes() == data:
+                return
+        except FileNotFoundError:
+            pass
+        self._cache.write_bytes(data)
+    
+    @staticmethod
+    def __flush_log(log:List[str]):
+        """write the buffered progress lines to stderr at once"""
+        if log:
+            sys.stderr.write(''.join(log))
+            sys.stderr.flush()
+            log.clear()
     
-    def compress(self, compression:int=zipfile.ZIP_DEFLATED, compresslevel:int=9):
-        global NAMEDTEMPORARYFILE_NAME
+    @staticmethod
+    def __should_store(filename:str) -> bool:
+        """check whether the head of a file barely compresses, run by worker threads"""
+        with open(filename, 'rb') as f:
+            sample = f.read(STORE_SAMPLE_SIZE)
+        return len(sample) > 0 and len(zlib.compress(sample, 1)) / len(sample) > STORE_SAMPLE_RATIO
+    
+    @staticmethod
+    def __write_stored(archive:zipfile.ZipFile, filename:str, arcname:str):
+        """write a file into archive without compression, copied in large chunks"""
+        zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        with open(filename, 'rb') as src, archive.open(zinfo, 'w') as dst:
+            shutil.copyfileobj(src, dst, length=1 << 20)
+    
+    def compress(self, compression:int=zipfile.ZIP_DEFLATED, compresslevel:int=6):
+        global TEMPORARYFILE_NAME
         
         print(f'\nconstructing {self.__save}/{self.__arcname}\n', file=sys.stderr)
 
@@ -292,43 +430,77 @@ class BackupManager:
         total_file_size = 0
         total_compress_size = 0
 
-        temp = tempfile.NamedTemporaryFile(prefix=self.target.split('/')[-1]+'_', dir=str(self.__save), mode='wb', delete=False)
-        NAMEDTEMPORARYFILE_NAME = temp.name
+        # progress lines are written to stderr in batches
+        log:List[str] = []
         
         if self.__preview:
-            for filename, arcname in self.__namelist(self.__target):
-                file_size = os.path.getsize(filename) if os.path.isfile(filename) else None
-                print(self.__color_path(arcname), f'({file_size})' if file_size else '', flush=True, file=sys.stderr)
+            for filename, arcname, is_file, file_size in self.__entries():
+                name = self.__color_path(arcname) if self.__is_tty else arcname
+                log.append(name + (f' ({file_size})\n' if file_size else ' \n'))
+                if len(log) >= LOG_BATCH_SIZE:
+                    self.__flush_log(log)
+            self.__flush_log(log)
             return
-            
-        with zipfile.ZipFile(temp, mode='w',
+        
+        fd, TEMPORARYFILE_NAME = tempfile.mkstemp(prefix=self.__target.name+'_', suffix='.zip.tmp', dir=str(self.__save))
+        
+        with os.fdopen(fd, 'wb') as temp, \
+             zipfile.ZipFile(temp, mode='w',
                                 compression=compression, 
-                                compresslevel=compresslevel) as archive:
-
-            for filename, arcname in self.__namelist(self.__target):
-                file_size = os.path.getsize(filename)
-                total_file_size += file_size
+                                compresslevel=compresslevel) as archive, \
+             ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            
+            # large files are sampled ahead in worker threads, to decide whether compression is worth it
+            # the archive itself is only written here
+            entries = iter(self.__entries())
+            pending:Deque[Tuple[Tuple[str, str, bool, Optional[int]], int, Optional[Future]]] = deque()
+            
+            def lookahead():
+                for filename, arcname, is_file, file_size in entries:
+                    compress_type = compression
+                    if is_file and os.path.splitext(arcname)[1].lower() in STORED_SUFFIXES:
+                        compress_type = zipfile.ZIP_STORED
+                    
+                    sample = None
+                    if is_file and file_size >= STORE_SAMPLE_THRESHOLD and compress_type != zipfile.ZIP_STORED:
+                        sample = executor.submit(self.__should_store, filename)
+                    pending.append(((filename, arcname, is_file, file_size), compress_type, sample))
+                    if len(pending) >= SAMPLE_WINDOW:
+                        return
+            
+            lookahead()
+            while pending:
+                (filename, arcname, is_file, file_size), compress_type, sample = pending.popleft()
+                lookahead()
                 
-                if os.path.isfile(filename):
-                    print(self.__color_path(arcname), f'({file_size} -> ', end='', flush=True, file=sys.stderr)
-                else:
-                    print(self.__color_path(arcname), file=sys.stderr)
+                if sample is not None and sample.result():
+                    compress_type = zipfile.ZIP_STORED
                 
-                archive.write(filename=filename, arcname=arcname)
+                if is_file and compress_type == zipfile.ZIP_STORED:
+                    self.__write_stored(archive, filename, arcname)
+                else:
+                    archive.write(filename=filename, arcname=arcname, compress_type=compress_type, compresslevel=compresslevel)
 
-                if os.path.isfile(filename):
+                name = self.__color_path(arcname) if self.__is_tty else arcname
+                if is_file:
+                    total_file_size += file_size
                     file_info = archive.getinfo(arcname)
                     if file_size > 0:
                         compress_size = file_info.compress_size
                         total_compress_size += compress_size
-                        print('%d deflate %.2f%%)'%(compress_size, (file_size-compress_size)/file_size*100), file=sys.stderr)
+                        log.append('%s (%d -> %d deflate %.2f%%)\n'%(name, file_size, compress_size, (file_size-compress_size)/file_size*100))
                     else:
-                        print('0 deflate 0%)', file=sys.stderr)
-        
-        temp.close()
+                        log.append(f'{name} (0 -> 0 deflate 0%)\n')
+                else:
+                    log.append(name + '\n')
+                
+                if len(log) >= LOG_BATCH_SIZE:
+                    self.__flush_log(log)
+            self.__flush_log(log)
         
-        shutil.move(NAMEDTEMPORARYFILE_NAME, f'{self.__save}/{self.__arcname}')
-        NAMEDTEMPORARYFILE_NAME = None
+        # same directory, so the finished zipfile is published by one atomic rename
+        os.replace(TEMPORARYFILE_NAME, f'{self.__save}/{self.__arcname}')
+        TEMPORARYFILE_NAME = None
         
         if total_file_size > 0:
             print('total deflate', '%.2f%%'%((total_file_size - total_compress_size)/total_file_size*100), file=sys.stderr)
@@ -387,7 +559,7 @@ if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        if not NAMEDTEMPORARYFILE_NAME is None:  
-            print('\nremoved temp file', NAMEDTEMPORARYFILE_NAME, file=sys.stderr)
-            os.unlink(NAMEDTEMPORARYFILE_NAME)
+        if not TEMPORARYFILE_NAME is None:  
+            print('\nremoved temp file', TEMPORARYFILE_NAME, file=sys.stderr)
+            os.unlink(TEMPORARYFILE_NAME)
         print(file=sys.stderr)
\ No newline at end of file